@@ -1,3 +1,15 @@
+import numpy as np
+from utils.helpers import cumulative_length
+
+
+def _line_arrays(line):
+    """
+    折线的顶点坐标 (N, 2) 和累积弧长 (N,) 数组。
+    """
+    coords = np.asarray(line.coords, dtype=np.float64).reshape(-1, 2)
+    return coords, cumulative_length(coords)
+
+
 class ClosedShape:
     def __init__(self, intersections, work_line_1, work_line_2, tangent_line_1, tangent_line_2, polygon):
         self.intersections = intersections
@@ -7,6 +19,40 @@ class ClosedShape:
         self.tangent_line_2 = tangent_line_2
         self.polygon = polygon
 
+    @property
+    def exterior_xy(self):
+        """
+        多边形外环坐标 (x 数组, y 数组)，首次访问时转换为 numpy 数组并缓存，polygon 被替换后自动失效。
+        """
+        cached = getattr(self, '_exterior_xy', None)
+        if cached is None or cached[0] is not self.polygon:
+            x, y = np.asarray(self.polygon.exterior.coords).T
+            cached = (self.polygon, x, y)
+            self._exterior_xy = cached
+        return cached[1], cached[2]
+
+    def _cached_line_arrays(self, attr):
+        line = getattr(self, attr)
+        cached = getattr(self, '_arrays_' + attr, None)
+        if cached is None or cached[0] is not line:
+            cached = (line, *_line_arrays(line))
+            setattr(self, '_arrays_' + attr, cached)
+        return cached[1], cached[2]
+
+    @property
+    def tangent_line_1_arrays(self):
+        """
+        tangent_line_1 的 (顶点坐标, 累积弧长) numpy 数组，首次访问时缓存。
+        """
+        return self._cached_line_arrays('tangent_line_1')
+
+    @property
+    def tangent_line_2_arrays(self):
+        """
+        tangent_line_2 的 (顶点坐标, 累积弧长) numpy 数组，首次访问时缓存。
+        """
+        return self._cached_line_arrays('tangent_line_2')
+
     def contains_point(self, point):
         return self.polygon.contains(point)
 
@@ -1,4 +1,5 @@
 import os
+from io import BytesIO
 import geopandas as gpd
 import pandas as pd
 import numpy as np
@@ -6,6 +7,7 @@ import docx
 from docx.shared import Inches, Pt, RGBColor
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.enum.table import WD_ALIGN_VERTICAL
+from PIL import Image
 from processing.close_shape import generate_closed_shapes_with_polylines
 from processing.normals import generate_infinite_normals_on_linestring_with_polyline
 from file_io.file_io import (
@@ -169,7 +171,8 @@ def run_processing_pipeline(config):
         save_path=ditch_output_path_prefix,
         log=True,
         manual_shp_path=manual_shp_path,
-        dam_line=dam_line
+        dam_line=dam_line,
+        workers=config.get("workers")
     )
     print(f"--- 任务: {job_name} 处理完成 ---")
 
@@ -235,38 +238,38 @@ def generate_error_reports(auto_csv_path: str, out_dir: str):
     df["squared_error_m2"] = df["error_m"] ** 2
     den = np.maximum(df["人工投影长度"], df["堤坝线投影长度"])
     df["绝对百分比误差(%)"] = (df["abs_error_m"] / den) * 100.0
-    per_row = df.copy()
+    # df 只在本函数内使用，后续聚合与导出均不修改它，因此直接作为逐行结果，无需复制
 
     # 按 (CODE, RIVERPART) 聚合
-    def agg_block(g):
-        # **MODIFIED: Removed dependency on "name" column for aggregation.**
-        return pd.Series({
-            "records": len(g),
-            "latest_date": pd.to_datetime(g["DATE"], errors="coerce").max(),
-            "人工投影长度_mean": float(g["人工投影长度"].mean()),
-            "堤坝线投影长度_mean": float(g["堤坝线投影长度"].mean()),
-            "MAE_m": float(g["abs_error_m"].mean()),
-            "RMSE_m": float(np.sqrt(g["squared_error_m2"].mean())),
-            "MAPE_percent_macro_per_ditch": float(g["绝对百分比误差(%)"].mean(skipna=True)),
-        })
-
-    per_ditch = (per_row.groupby(["CODE", "RIVERPART"], as_index=False)
-                 .apply(agg_block).reset_index(drop=True))
+    # **MODIFIED: Removed dependency on "name" column for aggregation.**
+    # 使用内置的命名聚合（向量化），避免 groupby().apply 对每个分组回调 Python 函数
+    group_keys = ["CODE", "RIVERPART"]
+    latest_date = (pd.to_datetime(df["DATE"], errors="coerce")
+                   .groupby([df[k] for k in group_keys]).max())
+    per_ditch = (df.groupby(group_keys, as_index=False)
+                 .agg(records=("error_m", "size"),
+                      人工投影长度_mean=("人工投影长度", "mean"),
+                      堤坝线投影长度_mean=("堤坝线投影长度", "mean"),
+                      MAE_m=("abs_error_m", "mean"),
+                      _mse=("squared_error_m2", "mean"),
+                      MAPE_percent_macro_per_ditch=("绝对百分比误差(%)", "mean")))
+    per_ditch.insert(per_ditch.columns.get_loc("_mse"), "RMSE_m", np.sqrt(per_ditch.pop("_mse")))
+    per_ditch.insert(per_ditch.columns.get_loc("records") + 1, "latest_date", latest_date.to_numpy())
 
     # 计算全局指标
-    global_mse = float(per_row["squared_error_m2"].mean())
+    global_mse = float(df["squared_error_m2"].mean())
     global_rmse = float(np.sqrt(global_mse))
-    macro_mape_all = float(per_row["绝对百分比误差(%)"].mean(skipna=True))
-    micro_den_series = np.maximum(per_row["人工投影长度"], per_row["堤坝线投影长度"])
-    mask = (per_row["人工投影长度"] > 0) & per_row["堤坝线投影长度"].notna()
-    micro_num = per_row.loc[mask, "abs_error_m"].sum()
+    macro_mape_all = float(df["绝对百分比误差(%)"].mean(skipna=True))
+    micro_den_series = np.maximum(df["人工投影长度"], df["堤坝线投影长度"])
+    mask = (df["人工投影长度"] > 0) & df["堤坝线投影长度"].notna()
+    micro_num = df.loc[mask, "abs_error_m"].sum()
     micro_den = micro_den_series[mask].sum()
     micro_mape_all = (micro_num / micro_den) * 100.0 if micro_den > 0 else np.nan
 
     # 导出到CSV
     per_row_path = os.path.join(out_dir, "per_row_errors.csv")
     per_ditch_path = os.path.join(out_dir, "per_ditch_summary.csv")
-    per_row.to_csv(per_row_path, index=False, encoding='utf-8-sig')
+    df.to_csv(per_row_path, index=False, encoding='utf-8-sig')
     per_ditch.to_csv(per_ditch_path, index=False, encoding='utf-8-sig')
 
     print(f"✔ 详细误差报告已保存至: {per_row_path}")
@@ -276,6 +279,32 @@ def generate_error_reports(auto_csv_path: str, out_dir: str):
     print("--- 误差报告生成完成 ---")
 
 
+def _shrink_png(image_path: str, colors: int = 128) -> BytesIO:
+    """
+    将PNG调色板量化后重新压缩编码，返回可直接传给 add_picture 的图片流。
+    matplotlib 输出的调试图颜色很少，量化到调色板模式几乎无损，但能显著减小 .docx 体积和保存时的压缩开销。
+    """
+    with Image.open(image_path) as im:
+        quantized = im.convert("RGB").convert("P", palette=Image.Palette.ADAPTIVE, colors=colors)
+    buf = BytesIO()
+    quantized.save(buf, "PNG", optimize=True)
+    buf.seek(0)
+    return buf
+
+
+def _add_key_value_table(doc, items: dict, style):
+    """
+    添加一个两列的“键-值”表格。
+    每行的单元格只取一次，避免反复通过 table.rows[i].cells[j] 重新遍历 XML 树。
+    """
+    table = doc.add_table(rows=len(items), cols=2, style=style)
+    for table_row, (key, value) in zip(table.rows, items.items()):
+        key_cell, value_cell = table_row.cells
+        key_cell.text = key
+        value_cell.text = value
+    return table
+
+
 def generate_word_report(csv_path: str, image_folder: str, output_word_path: str):
     """
     生成包含详细误差分析和图片的Word文档报告。
@@ -324,8 +353,8 @@ def generate_word_report(csv_path: str, image_folder: str, output_word_path: str
 
     # --- 新增操作：在Word中添加总体摘要表格 ---
     doc.add_heading('总体长度对比摘要', level=1)
-    summary_table = doc.add_table(rows=4, cols=2)
-    summary_table.style = 'Table Grid'
+    # 表格样式只按名称解析一次，后续每个表格直接复用样式对象
+    grid_style = doc.styles['Table Grid']
 
     summary_data = {
         '人工清沟投影总长度': f"{total_manual_length:.2f} m",
@@ -334,37 +363,42 @@ def generate_word_report(csv_path: str, image_folder: str, output_word_path: str
         '总体百分比误差(%)': f"{total_percentage_error:.2f} %" if not np.isnan(total_percentage_error) else "N/A"
     }
 
-    for i, (key, value) in enumerate(summary_data.items()):
-        summary_table.rows[i].cells[0].text = key
-        summary_table.rows[i].cells[1].text = value
+    _add_key_value_table(doc, summary_data, grid_style)
 
     # 使用分页符将摘要与详情分开
     doc.add_page_break()
 
     # --- 添加详细列表（此部分逻辑不变） ---
     doc.add_heading('清沟误差详细列表', level=1)
-    for index, row in df_sorted.iterrows():
+    # 一次性列出图片目录，之后按文件名做集合查找，代替每行两次 os.path.exists
+    existing_images = set(os.listdir(image_folder)) if os.path.isdir(image_folder) else set()
+    # 列名重命名为合法标识符，以便 itertuples 生成的命名元组可直接按属性访问
+    # （'绝对百分比误差(%)' 等列名无法作为属性名）
+    df_rows = df_sorted.rename(columns={
+        '清沟实际长度': 'ditch_len',
+        '堤坝线投影长度': 'dam_len',
+        '人工投影长度': 'manual_len',
+        sort_column: 'ape',
+    })
+    for row in df_rows.itertuples(index=True):
+        index = row.Index
         try:
             # **MODIFIED: Use CODE and RIVERPART as primary identifiers, removing dependency on 'name'.**
-            ditch_code = row['CODE']
-            river_part = row['RIVERPART']
+            ditch_code = row.CODE
+            river_part = row.RIVERPART
             # Create a unique, file-safe identifier consistent with the image generation script.
             unique_file_identifier = f"R_{ditch_code}_C_{river_part}"
 
             doc.add_heading(f"清沟 (CODE: {ditch_code}, RIVERPART: {river_part})", level=2)
 
             # 数据表格
-            table = doc.add_table(rows=4, cols=2)
-            table.style = 'Table Grid'
             keys_to_show = {
-                '清沟实际长度': f"{row.get('清沟实际长度', 0):.2f} m",
-                '堤坝线投影长度': f"{row.get('堤坝线投影长度', 0):.2f} m",
-                '人工投影长度': f"{row.get('人工投影长度', 0):.2f} m",
-                '绝对百分比误差(%)': f"{row.get(sort_column, 0):.2f} %"
+                '清沟实际长度': f"{getattr(row, 'ditch_len', 0):.2f} m",
+                '堤坝线投影长度': f"{getattr(row, 'dam_len', 0):.2f} m",
+                '人工投影长度': f"{getattr(row, 'manual_len', 0):.2f} m",
+                '绝对百分比误差(%)': f"{row.ape:.2f} %"
             }
-            for i, (key, value) in enumerate(keys_to_show.items()):
-                table.rows[i].cells[0].text = key
-                table.rows[i].cells[1].text = value
+            _add_key_value_table(doc, keys_to_show, grid_style)
 
             # **MODIFIED: Construct image names using the new unique identifier.**
             image_name = f"ditch__{unique_file_identifier}__proj.png"
@@ -375,17 +409,17 @@ def generate_word_report(csv_path: str, image_folder: str, output_word_path: str
             p = doc.add_paragraph()
             p.alignment = WD_ALIGN_PARAGRAPH.CENTER
 
-            if os.path.exists(image_path):
-                p.add_run().add_picture(image_path, width=Inches(5.5))
+            if image_name in existing_images:
+                p.add_run().add_picture(_shrink_png(image_path), width=Inches(5.5))
             else:
                 p.add_run(f"\n[警告: 图片未找到: {image_name}]").font.color.rgb = RGBColor(255, 0, 0)
 
-            if os.path.exists(image_with_closedshape_path):
-                p.add_run().add_picture(image_with_closedshape_path, width=Inches(5.5))
+            if image_with_closedshape_name in existing_images:
+                p.add_run().add_picture(_shrink_png(image_with_closedshape_path), width=Inches(5.5))
             else:
                 p.add_run(f"\n[警告: 图片未找到: {image_with_closedshape_name}]").font.color.rgb = RGBColor(255, 0, 0)
 
-        except KeyError as e:
+        except (KeyError, AttributeError) as e:
             print(f"因缺少列 {e}，已跳过行 {index}。")
             continue
         except Exception as e:
@@ -423,6 +457,8 @@ def main():
         print("检测到已存在的岸线文件，跳过预处理。")
 
     # --- 任务定义 ---
+    # 可选键 "workers"：清沟结果图的绘图进程数，缺省时串行绘制（默认，通常也更快）。
+    # 设为 > 1 时使用 spawn 进程池，本脚本须经 if __name__ == "__main__": 入口运行，详见 process_ditch_endpoints。
     tasks = [
         {
             "job_name": "20231226",
@@ -1,85 +1,187 @@
+import numpy as np
+import shapely
 from shapely.geometry import Polygon, LineString, Point
 from shapely.ops import substring
 from tqdm import tqdm
 from geometry.close_shape import ClosedShape
-from processing.splitting import extract_subcurve
+from processing.splitting import plot_subcurve
+from utils.helpers import cumulative_length, interpolate_xy
 
 
-def split_shape_if_needed(upper_segment, lower_segment, meters, current_above, current_below, next_above, next_below, log=False):
+def _split_at_half(coords, cumlen):
     """
-    递归拆分超过指定长度的封闭形状。
+    按弧长在中点处将折线坐标一分为二，返回 (前半段坐标, 后半段坐标, 中点)。
     """
-    upper_length = upper_segment.length
-    lower_length = lower_segment.length
+    if len(coords) < 2:
+        return coords, coords, coords[0]
+    half = cumlen[-1] / 2
+    k = min(int(np.searchsorted(cumlen, half, side='right')) - 1, len(coords) - 2)
+    seg_len = cumlen[k + 1] - cumlen[k]
+    t = (half - cumlen[k]) / seg_len if seg_len > 0 else 0.0
+    if t == 0:
+        # 中点恰好落在折点上，直接在该折点处拆分，避免产生重复点
+        return coords[:k + 1], coords[k:], coords[k]
+    mid = interpolate_xy(coords, cumlen, [half])[0]
+    return np.vstack([coords[:k + 1], mid]), np.vstack([mid, coords[k + 1:]]), mid
 
-    # 如果上边界或下边界长度超过限制，则拆分
-    if upper_length > meters or lower_length > meters:
-        # 计算北岸、南岸的中点
-        mid_upper = upper_segment.interpolate(0.5, normalized=True)
-        mid_lower = lower_segment.interpolate(0.5, normalized=True)
+
+def _substrings(line, start_dists, end_dists):
+    """
+    批量计算 substring(line, start_dists[i], end_dists[i])（距离均不小于 0），结果与 substring 逐位一致。
+    累积弧长只计算一次，每段的中间顶点用 searchsorted 直接切片，不再每段在 Python 中遍历整条线的坐标。
+    起止距离重合等退化为点的情况仍交给 substring 处理。
+    """
+    coords = np.asarray(line.coords, dtype=np.float64).reshape(-1, 2)
+    start_dists = np.asarray(start_dists, dtype=np.float64)
+    end_dists = np.asarray(end_dists, dtype=np.float64)
+    if len(coords) < 2:
+        return [substring(line, a, b) for a, b in zip(start_dists.tolist(), end_dists.tolist())]
+
+    cumlen = cumulative_length(coords)
+    start_xy = interpolate_xy(coords, cumlen, start_dists)
+    end_xy = interpolate_xy(coords, cumlen, end_dists)
+    # substring 只把各线段的起点作为中间顶点，且要求其弧长严格位于两端距离之间
+    vertex_dist = cumlen[:-1]
+    lo = np.searchsorted(vertex_dist, np.minimum(start_dists, end_dists), side='right')
+    hi = np.searchsorted(vertex_dist, np.maximum(start_dists, end_dists), side='left')
+
+    length = line.length
+    segments = []
+    for i, (a, b) in enumerate(zip(start_dists.tolist(), end_dists.tolist())):
+        if a == b or (a >= length and b >= length):
+            segments.append(substring(line, a, b))
+        elif a > b:
+            segments.append(LineString(np.vstack([end_xy[i], coords[lo[i]:hi[i]], start_xy[i]])[::-1]))
+        else:
+            segments.append(LineString(np.vstack([start_xy[i], coords[lo[i]:hi[i]], end_xy[i]])))
+    return segments
+
+
+def _build_closed_shape(upper_coords, lower_coords, current_above, current_below, next_above, next_below,
+                        tangent_line_1=None, tangent_line_2=None, build_polygon=True):
+    """
+    由上下边界坐标和四个角点构建 ClosedShape。角点均为 (x, y) 元组。
+    build_polygon=False 时不构建 polygon，由调用方通过 _assign_polygons 批量生成。
+    """
+    upper_list = [tuple(c) for c in np.asarray(upper_coords).tolist()]
+    lower_list = [tuple(c) for c in np.asarray(lower_coords).tolist()]
+    polygon_coords = [
+        current_above,
+        *upper_list,
+        next_above,
+        next_below,
+        *lower_list,
+        current_below,
+        current_above
+    ]
+    polygon = Polygon(polygon_coords) if build_polygon else None
+    return ClosedShape(
+        intersections=polygon_coords,
+        work_line_1=LineString([current_above, current_below]),
+        work_line_2=LineString([next_above, next_below]),
+        tangent_line_1=tangent_line_1 if tangent_line_1 is not None else LineString(upper_list),
+        tangent_line_2=tangent_line_2 if tangent_line_2 is not None else LineString(lower_list),
+        polygon=polygon
+    )
+
+
+def _assign_polygons(closed_shapes):
+    """
+    用 intersections 坐标一次性向量化构建所有 ClosedShape 的 polygon。
+    """
+    if not closed_shapes:
+        return
+    counts = [len(shape.intersections) for shape in closed_shapes]
+    coords = np.array([c for shape in closed_shapes for c in shape.intersections], dtype=np.float64)
+    rings = shapely.linearrings(coords, indices=np.repeat(np.arange(len(closed_shapes)), counts))
+    for shape, polygon in zip(closed_shapes, shapely.polygons(rings)):
+        shape.polygon = polygon
+
+
+def _split_coords_if_needed(upper, upper_cum, lower, lower_cum, meters,
+                            current_above, current_below, next_above, next_below, build_polygon=True):
+    """
+    split_shape_if_needed 的递归主体，直接在 numpy 坐标数组上按弧长拆分，
+    只在叶子节点才构建 Shapely 几何对象。
+    """
+    if upper_cum[-1] > meters or lower_cum[-1] > meters:
+        # 上边界方向为 current -> next；下边界方向为 next -> current
+        left_upper, right_upper, mid_upper = _split_at_half(upper, upper_cum)
+        right_lower, left_lower, mid_lower = _split_at_half(lower, lower_cum)
+        mid_upper = tuple(np.asarray(mid_upper).tolist())
+        mid_lower = tuple(np.asarray(mid_lower).tolist())
 
         # 递归拆分左半部分
-        left_upper = extract_subcurve(upper_segment, current_above, mid_upper, log=log)
-        left_lower = extract_subcurve(lower_segment, mid_lower, current_below, log=log)
-        left_shapes = split_shape_if_needed(
-            left_upper, left_lower, meters,
-            current_above, current_below, mid_upper, mid_lower, log
+        left_shapes = _split_coords_if_needed(
+            left_upper, cumulative_length(left_upper), left_lower, cumulative_length(left_lower), meters,
+            current_above, current_below, mid_upper, mid_lower, build_polygon
         )
-
         # 递归拆分右半部分
-        right_upper = extract_subcurve(upper_segment, mid_upper, next_above, log=log)
-        right_lower = extract_subcurve(lower_segment, next_below, mid_lower, log=log)
-        right_shapes = split_shape_if_needed(
-            right_upper, right_lower, meters,
-            mid_upper, mid_lower, next_above, next_below, log
+        right_shapes = _split_coords_if_needed(
+            right_upper, cumulative_length(right_upper), right_lower, cumulative_length(right_lower), meters,
+            mid_upper, mid_lower, next_above, next_below, build_polygon
         )
-
         return left_shapes + right_shapes
-    else:
-        # 不需要拆分，直接返回当前形状
-        polygon_coords = [
-            (current_above.x, current_above.y),
-            *list(upper_segment.coords),
-            (next_above.x, next_above.y),
-            (next_below.x, next_below.y),
-            *list(lower_segment.coords),
-            (current_below.x, current_below.y),
-            (current_above.x, current_above.y)
-        ]
-        polygon = Polygon(polygon_coords)
-        return [ClosedShape(
-            intersections=polygon_coords,
-            work_line_1=LineString([current_above, current_below]),
-            work_line_2=LineString([next_above, next_below]),
-            tangent_line_1=upper_segment,
-            tangent_line_2=lower_segment,
-            polygon=polygon
-        )]
+
+    return [_build_closed_shape(upper, lower, current_above, current_below, next_above, next_below,
+                                build_polygon=build_polygon)]
+
+
+def split_shape_if_needed(upper_segment, lower_segment, meters, current_above, current_below, next_above, next_below,
+                          build_polygon=True):
+    """
+    递归拆分超过指定长度的封闭形状。四个角点为 (x, y) 元组。
+    拆分在预先计算好累积弧长的坐标数组上进行，避免递归中反复调用 interpolate/substring。
+    build_polygon=False 时返回的形状 polygon 为 None，需由调用方批量构建。
+    """
+    corners = (current_above, current_below, next_above, next_below)
+
+    # 不需要拆分，直接返回当前形状
+    if upper_segment.length <= meters and lower_segment.length <= meters:
+        return [_build_closed_shape(upper_segment.coords, lower_segment.coords, *corners,
+                                    tangent_line_1=upper_segment, tangent_line_2=lower_segment,
+                                    build_polygon=build_polygon)]
+
+    upper = np.asarray(upper_segment.coords)
+    lower = np.asarray(lower_segment.coords)
+    return _split_coords_if_needed(upper, cumulative_length(upper), lower, cumulative_length(lower),
+                                   meters, *corners, build_polygon)
 
 
 def generate_closed_shapes_with_polylines(center_normals, north_line, south_line, meters, log=False):
     """
     生成封闭形状，并对超过 meters 长度的形状进行拆分。
+    法线端点直接以坐标元组参与计算，在南北岸线上的弧长位置一次性向量化求出，不再逐个构建 Point；
+    相邻法线之间的岸线子段按累积弧长批量切出，不再逐段调用 substring。
     """
-    closed_shapes = []
-    for i in tqdm(range(len(center_normals) - 1), desc="生成封闭形状", unit="个"):
-        current_point = center_normals[i][0]
-        next_point = center_normals[i + 1][0]
+    # (法线数, 2, 2)：每条法线的 [北端点, 南端点]
+    normal_ends = np.array([[c[:2] for c in normal[1].coords[:2]] for normal in center_normals], dtype=np.float64)
+    above_xy = [tuple(c) for c in normal_ends[:, 0].tolist()]  # 北
+    below_xy = [tuple(c) for c in normal_ends[:, 1].tolist()]  # 南
+    north_dist = shapely.line_locate_point(north_line, shapely.points(normal_ends[:, 0])) if len(normal_ends) else []
+    south_dist = shapely.line_locate_point(south_line, shapely.points(normal_ends[:, 1])) if len(normal_ends) else []
 
-        current_normal = center_normals[i][1].coords
-        next_normal = center_normals[i + 1][1].coords
+    # 所有相邻法线之间的南北岸线子段一次性切出
+    upper_segments = _substrings(north_line, north_dist[:-1], north_dist[1:]) if len(normal_ends) else []
+    lower_segments = _substrings(south_line, south_dist[1:], south_dist[:-1]) if len(normal_ends) else []
 
-        current_above = Point(current_normal[0][0], current_normal[0][1])  # 北
-        current_below = Point(current_normal[1][0], current_normal[1][1])  # 南
-        next_above = Point(next_normal[0][0], next_normal[0][1])  # 北
-        next_below = Point(next_normal[1][0], next_normal[1][1])  # 南
+    closed_shapes = []
+    for i in tqdm(range(len(center_normals) - 1), desc="生成封闭形状", unit="个"):
+        current_above, next_above = above_xy[i], above_xy[i + 1]
+        current_below, next_below = below_xy[i], below_xy[i + 1]
 
-        upper_segment = extract_subcurve(north_line, current_above, next_above, log=log)
-        lower_segment = extract_subcurve(south_line, next_below, current_below, log=log)
+        upper_segment = upper_segments[i]
+        lower_segment = lower_segments[i]
+        if log:
+            plot_subcurve(north_line, Point(current_above), Point(next_above), upper_segment)
+            plot_subcurve(south_line, Point(next_below), Point(current_below), lower_segment)
 
         closed_shapes.extend(
             split_shape_if_needed(upper_segment, lower_segment, meters,
-                                  current_above, current_below, next_above, next_below, log)
+                                  current_above, current_below, next_above, next_below,
+                                  build_polygon=False)
         )
 
+    # 所有形状的多边形在最后一次性向量化构建
+    _assign_polygons(closed_shapes)
     return closed_shapes
@@ -1,24 +1,48 @@
 import os
-import csv
 import hashlib
+import multiprocessing
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
+import shapely
 from pyproj import Geod, Transformer
-from shapely import LineString, MultiLineString, Point
+from shapely import LineString, MultiLineString, Point, STRtree
+from shapely.ops import substring
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 from matplotlib import rcParams
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.colors import to_rgba_array
+from matplotlib.figure import Figure
 import geopandas as gpd
-import pandas as pd
-from rtree import index  # 空间索引
+
+# pyogrio 通过 OGR C API 批量写出，比 Fiona 逐条写入快得多
+try:
+    import pyogrio  # noqa: F401
+    SHP_ENGINE = "pyogrio"
+except ImportError:  # 未安装 pyogrio 时使用 geopandas 默认引擎
+    SHP_ENGINE = None
 
 from file_io.file_io import load_polylines_from_shp
-from processing.splitting import extract_subcurve
-from utils.helpers import make_shape_finder, extract_subcurve_in_polygon_with_debug_plot, extract_subcurve_in_polygon
+from utils.helpers import make_shape_locator, make_line_projector, project_points_onto_polylines
 
 # --- Matplotlib 全局设置 ---
 rcParams['font.sans-serif'] = ['Microsoft YaHei', 'SimHei']
 rcParams['axes.unicode_minus'] = False
 
+# 清沟结果图的输出分辨率
+PLOT_DPI = 100
+# PNG 使用低压缩等级：编码耗时远小于默认等级，文件略大（写入 Word 报告时会再压缩）
+PLOT_PIL_KWARGS = {'compress_level': 1}
+# 清沟结果图中地图（坐标轴区域）长边的尺寸（英寸），短边按视图范围的纵横比确定
+PLOT_MAP_INCHES = 12.0
+# 地图四周的固定页边距（英寸），为刻度标签和标题留出空间
+PLOT_MARGIN_INCHES = dict(left=0.9, right=0.35, bottom=0.5, top=0.6)
+# 背景线（岸线/堤坝线/中心线）的简化容差（米）。清沟图每像素约 10 米以上，1 米以内的折点在图上不可见
+PLOT_BACKGROUND_SIMPLIFY_TOLERANCE = 1.0
+
 
 def _center_of_geom(geom):
     # 支持 LineString/Polygon/Point
@@ -26,9 +50,19 @@ def _center_of_geom(geom):
     return float(c.x), float(c.y)
 
 
+@lru_cache(maxsize=32)
+def _get_transformer(src_crs, dst_crs):
+    # 构建 Transformer 需要打开 PROJ 数据库，开销很大，按坐标系对缓存
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+@lru_cache(maxsize=8)
+def _get_geod(ellps):
+    return Geod(ellps=ellps)
+
+
 def _to_lonlat(x, y, src_crs="EPSG:32649", dst_crs="EPSG:4326"):
-    tf = Transformer.from_crs(src_crs, dst_crs, always_xy=True).transform
-    lon, lat = tf(x, y)
+    lon, lat = _get_transformer(src_crs, dst_crs).transform(x, y)
     return float(lon), float(lat)
 
 
@@ -46,19 +80,18 @@ def _square_view_bbox_in_degrees(center_geom_src, buffer_m=5000,
 
     # 3) 选择椭球：4326≈WGS84；4490≈GRS80
     if display_crs == "EPSG:4490":
-        geod = Geod(ellps="GRS80")
+        geod = _get_geod("GRS80")
     else:
-        geod = Geod(ellps="WGS84")
+        geod = _get_geod("WGS84")
 
-    # 4) 沿四个方位偏移 buffer_m，得到四个点
-    lon_e, lat_e, _ = geod.fwd(lon0, lat0, 90, buffer_m)  # 东
-    lon_w, lat_w, _ = geod.fwd(lon0, lat0, 270, buffer_m)  # 西
-    lon_n, lat_n, _ = geod.fwd(lon0, lat0, 0, buffer_m)  # 北
-    lon_s, lat_s, _ = geod.fwd(lon0, lat0, 180, buffer_m)  # 南
+    # 4) 沿四个方位（东/西/北/南）偏移 buffer_m，一次向量化调用得到四个点
+    lons, lats, _ = geod.fwd([lon0] * 4, [lat0] * 4, [90, 270, 0, 180], [buffer_m] * 4)
+    lon_e, lon_w = lons[0], lons[1]
+    lat_n, lat_s = lats[2], lats[3]
 
     # 5) 经/纬方向的半幅（度）
     half_lon = max(abs(lon_e - lon0), abs(lon0 - lon_w))
-    half_lat = max(abs(lat_n - lat0), abs(lat0 - s))
+    half_lat = max(abs(lat_n - lat0), abs(lat0 - lat_s))
 
     # 6) 取更大的那个，作为正方形半径（度）
     half_deg = max(half_lon, half_lat)
@@ -66,15 +99,223 @@ def _square_view_bbox_in_degrees(center_geom_src, buffer_m=5000,
     return lon0 - half_deg, lat0 - half_deg, lon0 + half_deg, lat0 + half_deg
 
 
+def _project_points_onto_tangent_lines(shapes, points):
+    """
+    批量将 points[i] 投影到 shapes[i].tangent_line_1 上，返回投影点数组。
+    使用 ClosedShape 上缓存的切线坐标/累积弧长数组，在 numpy 中一次性完成，不逐点调用 GEOS；
+    多个端点落在同一区域时，该区域的切线坐标只拼接一次。
+    """
+    if not shapes:
+        return np.empty(0, dtype=object)
+    line_index = {}
+    line_ids = [line_index.setdefault(id(shape), len(line_index)) for shape in shapes]
+    unique_shapes = list({id(shape): shape for shape in shapes}.values())
+    arrays = [shape.tangent_line_1_arrays for shape in unique_shapes]
+    line_offsets = np.concatenate(([0], np.cumsum([len(coords) for coords, _ in arrays])))
+    _, proj_xy = project_points_onto_polylines(
+        shapely.get_coordinates(points),
+        np.concatenate([coords for coords, _ in arrays]),
+        np.concatenate([cumlen for _, cumlen in arrays]),
+        line_offsets,
+        line_ids
+    )
+    return shapely.points(proj_xy)
+
+
+def _locate_ditch_endpoints(ditchs, closed_shapes):
+    """
+    为所有清沟的起点和终点查找所在封闭区域的索引，返回 (起点索引列表, 终点索引列表)，找不到时为 -1。
+    所有端点坐标一次性批量定位；完全相同的端点（重复测量的清沟、首尾相接的清沟）只定位一次。
+    """
+    xy = shapely.get_coordinates([ditch.points[0] for ditch in ditchs] + [ditch.points[-1] for ditch in ditchs])
+    unique_xy, inverse = np.unique(xy, axis=0, return_inverse=True)
+    unique_indices = make_shape_locator(closed_shapes)(unique_xy[:, 0], unique_xy[:, 1])
+    indices = unique_indices[inverse.reshape(-1)]
+    return indices[:len(ditchs)].tolist(), indices[len(ditchs):].tolist()
+
+
+def _csv_field(value):
+    """
+    按 csv 模块默认(QUOTE_MINIMAL)规则格式化单个字段：只有包含分隔符、引号或换行时才加引号。
+    """
+    text = '' if value is None else str(value)
+    if any(c in text for c in ',"\r\n'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+def _append_record(columns, record):
+    """
+    将一条记录按列追加到 columns 中；新出现的字段用 None 补齐之前的行，缺失的字段本行补 None。
+    """
+    n_rows = len(next(iter(columns.values()))) if columns else 0
+    for key, value in record.items():
+        column = columns.get(key)
+        if column is None:
+            column = columns[key] = [None] * n_rows
+        column.append(value)
+    for column in columns.values():
+        if len(column) == n_rows:
+            column.append(None)
+
+
+def _fit_ditch_figure(fig, view_bbox):
+    """
+    按视图范围的纵横比设置图幅尺寸和页边距，使等比例的地图正好填满坐标轴区域、四周不留空白。
+    保存时因此不需要 bbox_inches='tight'，省去每张图额外一次计算紧凑边界的绘制。
+    """
+    ratio = (view_bbox[3] - view_bbox[1]) / (view_bbox[2] - view_bbox[0])
+    if ratio <= 1:
+        map_w, map_h = PLOT_MAP_INCHES, PLOT_MAP_INCHES * ratio
+    else:
+        map_w, map_h = PLOT_MAP_INCHES / ratio, PLOT_MAP_INCHES
+    m = PLOT_MARGIN_INCHES
+    fig_w = map_w + m['left'] + m['right']
+    fig_h = map_h + m['bottom'] + m['top']
+    if tuple(fig.get_size_inches()) != (fig_w, fig_h):
+        fig.set_size_inches(fig_w, fig_h)
+        fig.subplots_adjust(left=m['left'] / fig_w, right=1 - m['right'] / fig_w,
+                            bottom=m['bottom'] / fig_h, top=1 - m['top'] / fig_h)
+
+
+def _make_ditch_plotter(background_lines, shape_rings, shape_facecolors):
+    """
+    构建清沟结果图共用的 Figure：背景线只绘制一次，封闭区域用一个常驻的 PolyCollection 表示。
+    参数均为可 pickle 的 numpy 数组，便于在绘图子进程中重建。
+    background_lines: [(坐标数组 (N, 2), 样式字典), ...]；shape_rings: 每个封闭区域的外环坐标 (N, 2)。
+    """
+    # 直接使用 Agg 画布，不经过 pyplot 状态机
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    for coords, style in background_lines:
+        ax.plot(coords[:, 0], coords[:, 1], **style)
+    ax.grid(True)
+    # 每条清沟只替换可见区域的顶点和颜色，一次绘制调用代替每个区域各自的 fill/plot 图元
+    shapes_collection = PolyCollection([], edgecolors=(0, 0, 0, 0.5), linewidths=0.6, visible=False,
+                                       rasterized=True)
+    ax.add_collection(shapes_collection, autolim=False)
+    return {
+        'fig': fig,
+        'ax': ax,
+        'shapes_collection': shapes_collection,
+        'shape_rings': shape_rings,
+        'shape_facecolors': shape_facecolors,
+    }
+
+
+# 绘图子进程内常驻的 Figure 等状态，由 _init_ditch_plotter_worker 在进程启动时构建一次
+_worker_plotter = None
+
+
+def _init_ditch_plotter_worker(background_lines, shape_rings, shape_facecolors):
+    global _worker_plotter
+    _worker_plotter = _make_ditch_plotter(background_lines, shape_rings, shape_facecolors)
+
+
+def _render_ditch_figures(ditch_data_dict, save_path, plotter=None):
+    """
+    绘制一条清沟的投影关系图和封闭区域图。ditch_data_dict 只包含坐标数组、长度和文本，可跨进程传递，
+    其中 view_bbox 为视图范围，visible_shape_indices 为视图内封闭区域的编号（升序）；
+    plotter 为 None 时使用子进程内的常驻 Figure。本条清沟的图元在保存后移除，背景留给下一条复用。
+    """
+    plotter = plotter or _worker_plotter
+    fig, ax = plotter['fig'], plotter['ax']
+    shapes_collection = plotter['shapes_collection']
+    d = ditch_data_dict
+    display_title = d['display_title']
+    x_ditch, y_ditch = d['ditch_xy']
+    view_bbox = d['view_bbox']
+
+    dynamic_artists = []
+    dynamic_artists += ax.plot(x_ditch, y_ditch, color="blue", linewidth=2.5, zorder=5, label=f"{display_title}")
+
+    # 绘制子线段高亮 (只绘制堤坝线)
+    if d['dam_segment_xy'] is not None:
+        dynamic_artists += ax.plot(*d['dam_segment_xy'], color="#994D00", linewidth=2.5, zorder=6,
+                                   label="堤坝线子线段")
+
+    if d['manual_xy'] is not None:
+        if d['manual_is_multi']:
+            for xy in d['manual_xy']:
+                dynamic_artists += ax.plot(*xy, color="black", linewidth=2.5, zorder=6)
+            dynamic_artists += ax.plot([], [], color="black", linewidth=2.5, zorder=6, label="人工投影")
+        else:
+            dynamic_artists += ax.plot(*d['manual_xy'][0], color="black", linewidth=2.5, zorder=6,
+                                       label="人工投影")
+
+    # 更新文本内容
+    text_content = (
+        f"长度 (米):\n"
+        f"  - 清沟实际: {d['ditch_length']:.2f}\n"
+        f"  - 堤坝线投影: {d['dam_length']:.2f}\n"
+    )
+    if d['manual_xy'] is not None:
+        text_content += f"  - 人工投影: {d['manual_length']:.2f}"
+
+    props = dict(boxstyle='round,pad=0.5', facecolor='wheat', alpha=0.7)
+    dynamic_artists.append(ax.text(0.02, 0.98, text_content, transform=ax.transAxes, fontsize=12,
+                                   verticalalignment='top', bbox=props))
+
+    _fit_ditch_figure(fig, view_bbox)
+    ax.set_xlim(view_bbox[0], view_bbox[2])
+    ax.set_ylim(view_bbox[1], view_bbox[3])
+    ax.set_aspect('equal', adjustable='box')
+    ax.legend(loc='lower left')
+
+    # 2. 投影线版
+    (start_x, start_y), (end_x, end_y) = d['endpoints_xy']
+    if d['dam_length'] > 0:
+        # 起点、终点两条投影线合并为一个 LineCollection 图元
+        start_proj_xy, end_proj_xy = d['proj_endpoints_xy']
+        projection_lines = LineCollection([((start_x, start_y), start_proj_xy), ((end_x, end_y), end_proj_xy)],
+                                          linestyles='--', colors='darkorange', linewidths=1.2, zorder=2)
+        ax.add_collection(projection_lines, autolim=False)
+        dynamic_artists.append(projection_lines)
+
+    dynamic_artists.append(ax.scatter([start_x, end_x], [start_y, end_y], color='purple', s=50, zorder=6))
+
+    ax.set_title(f"投影关系 - {display_title}", fontsize=16)
+    fig.savefig(os.path.join(save_path, f"ditch__{d['unique_file_identifier']}__proj.png"),
+                dpi=PLOT_DPI, pil_kwargs=PLOT_PIL_KWARGS)
+
+    # 3. 封闭图形版
+    visible_shape_indices = d['visible_shape_indices']
+    shapes_collection.set_verts([plotter['shape_rings'][j] for j in visible_shape_indices])
+    shapes_collection.set_facecolor(plotter['shape_facecolors'][visible_shape_indices])
+    shapes_collection.set_visible(True)
+    ax.set_title(f"封闭区域 - {display_title}", fontsize=16)
+    fig.savefig(os.path.join(save_path, f"ditch__{d['unique_file_identifier']}__closed.png"),
+                dpi=PLOT_DPI, pil_kwargs=PLOT_PIL_KWARGS)
+
+    shapes_collection.set_visible(False)
+    for artist in dynamic_artists:
+        artist.remove()
+
+
 def process_ditch_endpoints(ditchs, closed_shapes, left_line, right_line, dam_line, centerline,
-                            save_path=None, log=True, manual_shp_path=None):
+                            save_path=None, log=True, manual_shp_path=None, workers=None):
     """
     高效处理清沟：只投影到堤坝线，同时绘制南北岸线和中心线作为背景。
+    left_line / right_line / centerline 只用于绘图背景，可以传 None，此时不绘制对应的线。
+    workers 为结果图的绘图进程数（对应任务配置中的 "workers" 键）。缺省或 <= 1 时在主进程中串行绘制，这是默认做法：
+    子进程需各自导入 matplotlib 并接收封闭形状等绘图数据，实测 129 张图时进程池反而更慢（32 s 对 25 s）。
+    workers > 1 时改用 spawn 进程池绘图，CSV/SHP 写出仍在主进程中完成；spawn 子进程会重新导入调用方的主模块，
+    因此调用方必须位于 if __name__ == "__main__": 保护之下，否则子进程会重复执行整个流程并导致卡死。
+    log 控制结果图的输出：True 为每条清沟都绘图；整数 n 为每 n 条清沟绘制一条；
+    也可以传入函数 log(ditch) -> bool 只为需要的清沟绘图。端点不在任何区域内的调试图不受抽样影响。
     """
-    all_geometries_for_shp = []
+    # SHP 记录按列累积（列名 -> 值列表），最后直接构建 GeoDataFrame，避免由字典列表逐行推断
+    shp_columns = {}
 
     if not save_path:
         log = False
+    if callable(log):
+        should_plot = lambda k, ditch: bool(log(ditch))
+    elif isinstance(log, int) and not isinstance(log, bool) and log > 1:
+        should_plot = lambda k, ditch: k % log == 0
+    else:
+        should_plot = lambda k, ditch: bool(log)
 
     manual_projections = {}
     if manual_shp_path and os.path.exists(manual_shp_path):
@@ -84,21 +325,18 @@ def process_ditch_endpoints(ditchs, closed_shapes, left_line, right_line, dam_li
             print("⚠️ 未能从人工投影文件加载任何数据。")
             manual_shp_path = None
         else:
+            # 同一 (RIVERPART, CODE) 的线段先按列表累积，全部读完后每个键只构建一次几何对象
+            manual_parts = {}
             for polyline in manual_polylines:
                 attrs = polyline.attributes
                 river_part = attrs.get('RIVERPART')
                 code = attrs.get('CODE')
                 if river_part is not None and code is not None:
-                    composite_key = (river_part, code)
-                    new_line = LineString(polyline.points)
-                    if composite_key in manual_projections:
-                        existing_geom = manual_projections[composite_key]
-                        if isinstance(existing_geom, LineString):
-                            manual_projections[composite_key] = MultiLineString([existing_geom, new_line])
-                        elif isinstance(existing_geom, MultiLineString):
-                            manual_projections[composite_key] = MultiLineString(list(existing_geom.geoms) + [new_line])
-                    else:
-                        manual_projections[composite_key] = new_line
+                    manual_parts.setdefault((river_part, code), []).append(LineString(polyline.points))
+            manual_projections = {
+                composite_key: lines[0] if len(lines) == 1 else MultiLineString(lines)
+                for composite_key, lines in manual_parts.items()
+            }
             if not manual_projections:
                 print("⚠️ 错误: 人工投影数据中缺少 'RIVERPART' 和/或 'CODE' 字段，无法进行匹配。")
                 manual_shp_path = None
@@ -107,27 +345,41 @@ def process_ditch_endpoints(ditchs, closed_shapes, left_line, right_line, dam_li
 
     if log:
         print("正在为背景区域创建空间索引...")
-        idx_shapes = index.Index()
-        for i, shape in enumerate(closed_shapes):
-            idx_shapes.insert(i, shape.polygon.bounds)
+        # 一次性批量构建 STRtree；所有清沟视图内的封闭区域在绘图前用一次批量查询得到
+        shapes_tree = STRtree([shape.polygon for shape in closed_shapes])
+        # 每个封闭区域的颜色只与区域编号有关，预先计算一次，避免每条清沟重复哈希
+        shape_colors = ['#' + hashlib.md5(str(j).encode()).hexdigest()[:6] for j in range(len(closed_shapes))]
+        shape_facecolors = to_rgba_array(shape_colors, alpha=0.25) if closed_shapes else np.empty((0, 4))
+        shape_rings = [np.column_stack(shape.exterior_xy) for shape in closed_shapes]
+        # 背景线坐标在所有清沟之间共享，只转换并简化一次（去掉图上不可见的密集折点）；未提供的背景线跳过
+        background_lines = [
+            (shapely.get_coordinates(shapely.simplify(line, PLOT_BACKGROUND_SIMPLIFY_TOLERANCE)), style)
+            for line, style in (
+                (centerline, dict(color="gray", linewidth=1.5, label="中心线")),
+                (right_line, dict(color="#1f77b4", linewidth=2, label="右岸线")),
+                (left_line, dict(color="#d62728", linewidth=2, label="左岸线")),
+                (dam_line, dict(color="orange", linewidth=2, label="堤坝线")),
+            ) if line is not None
+        ]
+        plotter_args = (background_lines, shape_rings, shape_facecolors)
+        plot_tasks = []  # 每条需要绘图的清沟的可 pickle 数据，循环结束后统一绘制
         print("✅ 空间索引创建完成。")
 
     if save_path:
+        # 输出目录只在进入清沟循环前创建一次；log 只在 save_path 有效时开启，循环内无需再检查
         os.makedirs(save_path, exist_ok=True)
         csv_filename = os.path.join(save_path, "ditch_results.csv")
     else:
         csv_filename = "ditch_results.csv"
 
-    with open(csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-        csv_writer = csv.writer(csvfile)
+    with open(csv_filename, 'w', newline='', encoding='utf-8', buffering=1 << 20) as csvfile:
         # 更新CSV表头，移除中心线投影
-        csv_writer.writerow([
-            "name", "DATE", "RIVERPART", "CODE",
-            "清沟实际长度", "堤坝线投影长度", "人工投影长度"
-        ])
-        finder = make_shape_finder(closed_shapes)
+        csvfile.write("name,DATE,RIVERPART,CODE,清沟实际长度,堤坝线投影长度,人工投影长度\r\n")
+        start_indices, end_indices = _locate_ditch_endpoints(ditchs, closed_shapes)
 
-        for ditch in tqdm(ditchs, desc="处理所有清沟", unit="条"):
+        # --- 第一遍：为每条清沟的起点/终点定位所在的封闭区域 ---
+        located = []  # (ditch, code, river_part, unique_file_identifier, display_title, start_shape, end_shape)
+        for ditch, start_index, end_index in zip(ditchs, start_indices, end_indices):
             start_point, end_point = ditch.points[0], ditch.points[-1]
             ditch_attributes = ditch.attributes
 
@@ -138,11 +390,10 @@ def process_ditch_endpoints(ditchs, closed_shapes, left_line, right_line, dam_li
             display_title = f"清沟 (CODE: {code}, RIVERPART: {river_part})"
 
             # --- 起点处理 (MODIFIED) ---
-            find_result_start = finder(start_point)
-            if find_result_start is None:
+            if start_index < 0:
                 print(f"⚠️ 警告: 未能为清沟 '{display_title}' 的起点找到封闭区域。")
 
-                if log and save_path:
+                if log:
                     debug_save_path = os.path.join(save_path,
                                                    f"DEBUG_ditch_{unique_file_identifier}_START_POINT_OUTSIDE.png")
                     plot_debug_point_outside_shapes(
@@ -154,17 +405,13 @@ def process_ditch_endpoints(ditchs, closed_shapes, left_line, right_line, dam_li
                         save_path=debug_save_path
                     )
                 continue
-            start_index, start_shape = find_result_start
-            proj_start_dam_point = start_shape.tangent_line_1.interpolate(
-                start_shape.tangent_line_1.project(start_point)
-            ) if start_shape and hasattr(start_shape, 'tangent_line_1') else None
+            start_shape = closed_shapes[start_index]
 
             # --- 终点处理 (MODIFIED) ---
-            find_result_end = finder(end_point)
-            if find_result_end is None:
+            if end_index < 0:
                 print(f"⚠️ 警告: 未能为清沟 '{display_title}' 的终点找到封闭区域。")
 
-                if log and save_path:
+                if log:
                     debug_save_path = os.path.join(save_path,
                                                    f"DEBUG_ditch_{unique_file_identifier}_END_POINT_OUTSIDE.png")
                     plot_debug_point_outside_shapes(
@@ -176,18 +423,50 @@ def process_ditch_endpoints(ditchs, closed_shapes, left_line, right_line, dam_li
                         save_path=debug_save_path
                     )
                 continue
-            end_index, end_shape = find_result_end
-            proj_end_dam_point = end_shape.tangent_line_1.interpolate(
-                end_shape.tangent_line_1.project(end_point)
-            ) if end_shape and hasattr(end_shape, 'tangent_line_1') else None
+            end_shape = closed_shapes[end_index]
+
+            located.append((ditch, code, river_part, unique_file_identifier, display_title, start_shape, end_shape))
+
+        # --- 批量投影：一次向量化调用将所有端点投影到各自封闭区域的堤坝侧切线上 ---
+        proj_start_dam_points = _project_points_onto_tangent_lines(
+            [item[5] for item in located], [item[0].points[0] for item in located])
+        proj_end_dam_points = _project_points_onto_tangent_lines(
+            [item[6] for item in located], [item[0].points[-1] for item in located])
+
+        # --- 堤坝线投影长度：只需要长度时，直接用两投影点在堤坝线上的弧长坐标之差，无需构建子曲线 ---
+        # 堤坝线的顶点/累积弧长/线段索引只构建一次，所有投影点通过最近线段查询定位
+        project_onto_dam_line = make_line_projector(dam_line)
+        dam_start_s, _ = project_onto_dam_line(shapely.get_coordinates(proj_start_dam_points))
+        dam_end_s, _ = project_onto_dam_line(shapely.get_coordinates(proj_end_dam_points))
+        dam_lengths = np.abs(dam_end_s - dam_start_s)
+
+        # 不同清沟常投影到堤坝线上相同的区段；子曲线按毫米级取整的弧长坐标缓存，SHP 与绘图也共用同一结果。
+        # 子曲线只用于 SHP 和绘图，二者都需要 save_path；未指定 save_path 时只输出 CSV，不构建子曲线
+        dam_subcurves = {}
+
+        # 清沟实际长度同样一次性向量化计算
+        ditch_lengths = shapely.length([item[0].line for item in located])
+
+        # --- 第二遍：计算长度、写出结果并绘图 ---
+        csv_lines = []  # 结果行先在内存中格式化累积，循环结束后一次性写出
+        for k, (ditch, code, river_part, unique_file_identifier, display_title, start_shape, end_shape) in enumerate(
+                tqdm(located, desc="处理所有清沟", unit="条")):
+            start_point, end_point = ditch.points[0], ditch.points[-1]
+            ditch_attributes = ditch.attributes
+            proj_start_dam_point = proj_start_dam_points[k]
+            proj_end_dam_point = proj_end_dam_points[k]
 
             # --- 计算投影长度 ---
-            if proj_start_dam_point and proj_end_dam_point:
-                dam_length = extract_subcurve(dam_line, proj_start_dam_point, proj_end_dam_point).length
-            else:
-                dam_length = 0
+            dam_length = float(dam_lengths[k])
+            dam_segment = None
+            if dam_length > 0 and save_path:
+                s1, s2 = float(dam_start_s[k]), float(dam_end_s[k])
+                subcurve_key = (round(s1, 3), round(s2, 3))
+                dam_segment = dam_subcurves.get(subcurve_key)
+                if dam_segment is None:
+                    dam_segment = dam_subcurves[subcurve_key] = substring(dam_line, s1, s2)
 
-            ditch_length = ditch.line.length
+            ditch_length = float(ditch_lengths[k])
 
             # 人工投影长度计算
             manual_geom = None
@@ -197,126 +476,81 @@ def process_ditch_endpoints(ditchs, closed_shapes, left_line, right_line, dam_li
             manual_length = manual_geom.length if manual_geom else 0
 
             # --- CSV 保存 ---
-            csv_writer.writerow([
-                ditch_attributes.get('name', 'N/A'), ditch_attributes.get('DATE', 'N/A'),
-                river_part, code,
-                f"{ditch_length:.2f}", f"{dam_length:.2f}", f"{manual_length:.2f}"
-            ])
-
-            # --- SHP 记录 (更新) ---
-            base_record = ditch_attributes.copy()
-            base_record.update({
-                'ditch_len': ditch_length,
-                'dam_len': dam_length,
-                'manual_len': manual_length
-            })
-
-            geometries_to_save = {
-                'original_ditch': ditch.line,
-                'dam_projection': extract_subcurve(dam_line, proj_start_dam_point,
-                                                   proj_end_dam_point) if dam_length > 0 else None,
-                'manual_projection': manual_geom
-            }
-
-            for line_type, geom in geometries_to_save.items():
-                if geom and not geom.is_empty:
-                    record = base_record.copy()
-                    record['line_type'] = line_type
-                    record['geometry'] = geom
-                    all_geometries_for_shp.append(record)
-
-            # --- 绘图 (更新) ---
-            if log:
-                x_ditch, y_ditch = ditch.line.xy
-                min_x, max_x = min(x_ditch), max(x_ditch)
-                min_y, max_y = min(y_ditch), max(y_ditch)
-                view_bbox = (min_x - 8000, min_y - 8000, max_x + 8000, max_y + 8000)
-
-                fig, ax = plt.subplots(figsize=(18, 12))
-
-                # 1. 基础背景
-                ax.plot(*centerline.xy, color="gray", linewidth=1.5, label="中心线")
-                ax.plot(*right_line.xy, color="#1f77b4", linewidth=2, label="右岸线")
-                ax.plot(*left_line.xy, color="#d62728", linewidth=2, label="左岸线")
-                ax.plot(*dam_line.xy, color="orange", linewidth=2, label="堤坝线")
-                ax.plot(x_ditch, y_ditch, color="blue", linewidth=2.5, zorder=5, label=f"{display_title}")
-
-                # 绘制子线段高亮 (只绘制堤坝线)
-                if dam_length > 0:
-                    seg = extract_subcurve(dam_line, proj_start_dam_point, proj_end_dam_point)
-                    ax.plot(*seg.xy, color="#994D00", linewidth=2.5, zorder=6, label="堤坝线子线段")
-
-                if manual_geom:
-                    if manual_geom.geom_type == 'MultiLineString':
-                        for line in manual_geom.geoms:
-                            ax.plot(*line.xy, color="black", linewidth=2.5, zorder=6)
-                        ax.plot([], [], color="black", linewidth=2.5, zorder=6, label="人工投影")
-                    else:
-                        ax.plot(*manual_geom.xy, color="black", linewidth=2.5, zorder=6, label="人工投影")
-
-                # 更新文本内容
-                text_content = (
-                    f"长度 (米):\n"
-                    f"  - 清沟实际: {ditch_length:.2f}\n"
-                    f"  - 堤坝线投影: {dam_length:.2f}\n"
+            csv_lines.append(
+                f"{_csv_field(ditch_attributes.get('name', 'N/A'))},{_csv_field(ditch_attributes.get('DATE', 'N/A'))},"
+                f"{_csv_field(river_part)},{_csv_field(code)},"
+                f"{ditch_length:.2f},{dam_length:.2f},{manual_length:.2f}\r\n"
+            )
+
+            # --- SHP 记录 (更新)：只有 save_path 有效时才会写出 SHP ---
+            # 只为非空几何生成记录，记录直接由清沟属性和长度字段合并而成，不再先复制 base_record
+            if save_path:
+                geometries_to_save = (
+                    ('original_ditch', ditch.line),
+                    ('dam_projection', dam_segment),
+                    ('manual_projection', manual_geom),
                 )
-                if manual_geom:
-                    text_content += f"  - 人工投影: {manual_length:.2f}"
-
-                props = dict(boxstyle='round,pad=0.5', facecolor='wheat', alpha=0.7)
-                ax.text(0.02, 0.98, text_content, transform=ax.transAxes, fontsize=12,
-                        verticalalignment='top', bbox=props)
-
-                ax.set_xlim(view_bbox[0], view_bbox[2])
-                ax.set_ylim(view_bbox[1], view_bbox[3])
-                ax.set_aspect('equal', adjustable='box')
-                ax.grid(True)
-                ax.legend(loc='lower left')
-                ax.set_title(display_title, fontsize=16)
-
-                # **MODIFIED: Saving with the new unique identifier.**
-                # Note: The 'base' image is commented out as it's redundant with the 'proj' image after adding projection lines.
-                # You can uncomment it if you need the image without projection lines.
-                # plt.savefig(os.path.join(save_path, f"ditch__{unique_file_identifier}__base.png"),
-                #             dpi=120, bbox_inches='tight')
-
-                # 2. 投影线版
-                if dam_length > 0:
-                    ax.plot([start_point.x, proj_start_dam_point.x], [start_point.y, proj_start_dam_point.y],
-                            '--', color='darkorange', linewidth=1.2)
-                    ax.plot([end_point.x, proj_end_dam_point.x], [end_point.y, proj_end_dam_point.y],
-                            '--', color='darkorange', linewidth=1.2)
-
-                ax.scatter([start_point.x, end_point.x],
-                           [start_point.y, end_point.y],
-                           color='purple', s=50, zorder=6)
-
-                ax.set_title(f"投影关系 - {display_title}", fontsize=16)
-                plt.savefig(os.path.join(save_path, f"ditch__{unique_file_identifier}__proj.png"),
-                            dpi=120, bbox_inches='tight')
-
-                # 3. 封闭图形版
-                visible_shape_indices = list(idx_shapes.intersection(view_bbox))
-                for j in visible_shape_indices:
-                    shape = closed_shapes[j]
-                    px, py = shape.polygon.exterior.xy
-                    color = '#' + hashlib.md5(str(j).encode()).hexdigest()[:6]
-                    ax.fill(px, py, color=color, alpha=0.25)
-                    ax.plot(px, py, color="black", linewidth=0.6, alpha=0.5)
-                ax.set_title(f"封闭区域 - {display_title}", fontsize=16)
-                plt.savefig(os.path.join(save_path, f"ditch__{unique_file_identifier}__closed.png"),
-                            dpi=120, bbox_inches='tight')
-
-                plt.close(fig)
+                for line_type, geom in geometries_to_save:
+                    if geom and not geom.is_empty:
+                        _append_record(shp_columns, {
+                            **ditch_attributes,
+                            'ditch_len': ditch_length,
+                            'dam_len': dam_length,
+                            'manual_len': manual_length,
+                            'line_type': line_type,
+                            'geometry': geom
+                        })
+
+            # --- 绘图数据：只收集坐标数组和数值，绘制在循环结束后进行（可并行） ---
+            if log and should_plot(k, ditch):
+                ditch_xy = np.asarray(ditch.line.xy)
+                plot_tasks.append({
+                    'display_title': display_title,
+                    'unique_file_identifier': unique_file_identifier,
+                    'ditch_xy': ditch_xy,
+                    'view_bbox': (*(ditch_xy.min(axis=1) - 8000), *(ditch_xy.max(axis=1) + 8000)),
+                    'dam_segment_xy': np.asarray(dam_segment.xy) if dam_length > 0 else None,
+                    'manual_xy': [np.asarray(line.xy) for line in getattr(manual_geom, 'geoms', [manual_geom])]
+                    if manual_geom else None,
+                    'manual_is_multi': manual_geom is not None and manual_geom.geom_type == 'MultiLineString',
+                    'ditch_length': ditch_length,
+                    'dam_length': dam_length,
+                    'manual_length': manual_length,
+                    'endpoints_xy': ((start_point.x, start_point.y), (end_point.x, end_point.y)),
+                    'proj_endpoints_xy': ((proj_start_dam_point.x, proj_start_dam_point.y),
+                                          (proj_end_dam_point.x, proj_end_dam_point.y)),
+                })
+
+        csvfile.write(''.join(csv_lines))
+
+    # --- 绘图：各条清沟之间没有共享状态，workers > 1 时分发到进程池，每个子进程复用自己的 Figure ---
+    # 主进程此前可能已启动 numba 并行线程池，fork 出的子进程不安全，因此固定使用 spawn 启动
+    if log and plot_tasks:
+        # 所有视图范围一次查询：返回 (清沟序号, 区域编号) 对，按清沟分组后区域编号升序
+        view_boxes = np.array([task['view_bbox'] for task in plot_tasks])
+        task_ids, shape_ids = shapes_tree.query(shapely.box(*view_boxes.T))
+        order = np.lexsort((shape_ids, task_ids))
+        splits = np.searchsorted(task_ids[order], np.arange(1, len(plot_tasks)))
+        for task, visible_shape_indices in zip(plot_tasks, np.split(shape_ids[order], splits)):
+            task['visible_shape_indices'] = visible_shape_indices
+        if workers and workers > 1 and len(plot_tasks) > 1:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_ditch_plotter_worker, initargs=plotter_args) as executor:
+                futures = [executor.submit(_render_ditch_figures, task, save_path) for task in plot_tasks]
+                for future in tqdm(as_completed(futures), total=len(futures), desc="绘制清沟结果图", unit="条"):
+                    future.result()
+        else:
+            plotter = _make_ditch_plotter(*plotter_args)
+            for task in tqdm(plot_tasks, desc="绘制清沟结果图", unit="条"):
+                _render_ditch_figures(task, save_path, plotter)
 
     # --- 保存 SHP (逻辑不变) ---
-    if save_path and all_geometries_for_shp:
+    if save_path and shp_columns:
         print("\n正在将所有处理结果保存到 SHP 文件...")
         try:
-            df = pd.DataFrame(all_geometries_for_shp)
-            gdf = gpd.GeoDataFrame(df, geometry='geometry', crs="EPSG:32650")
+            gdf = gpd.GeoDataFrame(shp_columns, geometry='geometry', crs="EPSG:32650")
             shp_output_path = os.path.join(save_path, "processed_ditches_with_projections.shp")
-            gdf.to_file(shp_output_path, driver='ESRI Shapefile', encoding='utf-8')
+            gdf.to_file(shp_output_path, driver='ESRI Shapefile', encoding='utf-8', engine=SHP_ENGINE)
             print(f"✅ 所有清沟处理结果已成功保存到: {shp_output_path}")
         except Exception as e:
             print(f"⚠️ 保存 SHP 文件时发生错误: {e}")
@@ -339,7 +573,7 @@ def plot_debug_point_outside_shapes(
 
     # 1. 绘制所有的封闭区域作为背景
     for shape in all_closed_shapes:
-        px, py = shape.polygon.exterior.xy
+        px, py = shape.exterior_xy
         ax.plot(px, py, 'b-', linewidth=1, alpha=0.5)
         ax.fill(px, py, 'lightblue', alpha=0.3)
 
@@ -371,5 +605,5 @@ def plot_debug_point_outside_shapes(
 
     # 6. 保存并显示
     print(f"    -> 正在保存调试图到: {save_path}")
-    plt.savefig(save_path, dpi=120, bbox_inches='tight')
+    plt.savefig(save_path, dpi=PLOT_DPI, bbox_inches='tight', pil_kwargs=PLOT_PIL_KWARGS)
     plt.close(fig)
\ No newline at end of file
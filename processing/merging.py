@@ -4,105 +4,134 @@
 
 import matplotlib.pyplot as plt
 import random
+import numpy as np
+from rtree import index
 from geometry.polyline import Polyline
 
 
-def find_starting_polyline(polylines):
+def _endpoint_array(polylines):
     """
-    找到起始多段线（通常选择最左下角的点所在的线）。
+    所有多段线首尾端点的坐标数组 (2n, 2)：第 2*i 行为第 i 条线的起点，第 2*i+1 行为终点。
     """
-    min_point = None
-    starting_polyline = None
-    starting_points = []
+    return np.array([[p.x, p.y] for polyline in polylines for p in (polyline.points[0], polyline.points[-1])],
+                    dtype=np.float64).reshape(-1, 2)
 
-    for polyline in polylines:
-        for point in [polyline.points[0], polyline.points[-1]]:
-            if min_point is None or (point.x < min_point.x or (point.x == min_point.x and point.y < min_point.y)):
-                min_point = point
-                starting_polyline = polyline
-                starting_points = polyline.points if point == polyline.points[0] else list(reversed(polyline.points))
 
-    return starting_polyline, starting_points
+def find_starting_polyline(polylines, endpoints=None):
+    """
+    找到起始多段线（通常选择最左下角的点所在的线）。
+    在端点坐标数组上一次排序求出，x 最小者优先，x 相同时取 y 最小者，完全相同时取最先出现者。
+    endpoints 为调用方已构建的 _endpoint_array(polylines)，省略时在此构建。
+    """
+    polylines = list(polylines)
+    if not polylines:
+        return None, []
+    if endpoints is None:
+        endpoints = _endpoint_array(polylines)
+    k = int(np.lexsort((endpoints[:, 1], endpoints[:, 0]))[0])
+    starting_polyline = polylines[k // 2]
+    # 排序稳定：最小点为终点时，该线起点必然不与之重合，需反转方向
+    if k % 2 == 1:
+        return starting_polyline, list(reversed(starting_polyline.points))
+    return starting_polyline, starting_polyline.points
+
+
+def _build_endpoint_index(endpoints):
+    """
+    为端点坐标数组批量建立 R 树索引，条目编号即数组行号（2*i 为第 i 条线的起点，2*i+1 为终点）。
+    合并过程中会频繁删除条目，较小的节点容量使删除和最近邻查询都更快。
+    """
+    properties = index.Property()
+    properties.leaf_capacity = 16
+    properties.index_capacity = 16
+    return index.Index(((k, (x, y, x, y), None) for k, (x, y) in enumerate(endpoints.tolist())),
+                       properties=properties)
 
 
-def find_closest_polyline(current_end, polylines):
+def _remove_from_endpoint_index(endpoint_index, endpoints, i):
     """
-    找到离当前端点最近的多段线及其正确方向的点列表。
+    从端点索引中删除第 i 条多段线的两个端点。
     """
-    min_distance = float('inf')
-    closest_polyline = None
-    best_orientation_is_reversed = False
+    for k in (2 * i, 2 * i + 1):
+        x, y = endpoints[k]
+        endpoint_index.delete(k, (x, y, x, y))
 
-    for polyline in polylines:
-        start_dist = current_end.distance(polyline.points[0])
-        if start_dist < min_distance:
-            min_distance = start_dist
-            closest_polyline = polyline
-            best_orientation_is_reversed = False
-
-        end_dist = current_end.distance(polyline.points[-1])
-        if end_dist < min_distance:
-            min_distance = end_dist
-            closest_polyline = polyline
-            best_orientation_is_reversed = True
-
-    if closest_polyline is None:
-        return None, [], float('inf')
 
-    if best_orientation_is_reversed:
-        closest_points = list(reversed(closest_polyline.points))
-    else:
-        closest_points = closest_polyline.points
+def find_closest_polyline(current_end, endpoint_index, polylines):
+    """
+    找到离当前端点最近的多段线及其正确方向的点列表：通过端点 R 树查询最近的端点，不逐条扫描剩余多段线。
+    endpoint_index 由 _build_endpoint_index 构建，已合并的多段线需从索引中删除。
+    返回 (多段线编号, 正确方向的点列表, 距离)，找不到时为 (None, [], inf)。
+    """
+    nearest = list(endpoint_index.nearest((current_end.x, current_end.y, current_end.x, current_end.y), 1))
+    if not nearest:
+        return None, [], float('inf')
 
-    return closest_polyline, closest_points, min_distance
+    # 距离相同的端点会一并返回，取编号最小者（同一条线起点优先），保证结果确定
+    entry = min(nearest)
+    i, is_reversed = divmod(entry, 2)
+    polyline = polylines[i]
+    if is_reversed:
+        return i, list(reversed(polyline.points)), current_end.distance(polyline.points[-1])
+    return i, polyline.points, current_end.distance(polyline.points[0])
 
 
 def merge_polylines(polylines, log=False):
     """
     合并多段线（已重构为双向生长算法）。
+    每一步在首尾端点的 R 树索引中查找离当前头/尾最近的端点，整体复杂度约为 O(n log n)。
     """
     if not polylines:
         return None
 
-    polylines_to_process = set(polylines)
+    # 去重并保持输入顺序
+    unique_polylines = list(dict.fromkeys(polylines))
 
-    starting_polyline, merged_points = find_starting_polyline(list(polylines_to_process))
+    endpoints = _endpoint_array(unique_polylines)
+    starting_polyline, merged_points = find_starting_polyline(unique_polylines, endpoints)
     if not starting_polyline:
         return None
 
-    polylines_to_process.remove(starting_polyline)
+    endpoint_index = _build_endpoint_index(endpoints)
+    _remove_from_endpoint_index(endpoint_index, endpoints, unique_polylines.index(starting_polyline))
+    remaining = len(unique_polylines) - 1
 
     step = 0
     if log:
         plot_polylines_with_labels_and_merged(polylines, merged_points, step)
 
-    while polylines_to_process:
+    while remaining:
         current_start = merged_points[0]
         current_end = merged_points[-1]
 
         # 寻找连接到尾部的最佳线段
-        poly_to_append, points_to_append, dist_to_end = find_closest_polyline(current_end, polylines_to_process)
+        append_index, points_to_append, dist_to_end = find_closest_polyline(
+            current_end, endpoint_index, unique_polylines)
 
         # 寻找连接到头部的最佳线段
-        poly_to_prepend, points_to_prepend, dist_to_start = find_closest_polyline(current_start, polylines_to_process)
+        prepend_index, points_to_prepend, dist_to_start = find_closest_polyline(
+            current_start, endpoint_index, unique_polylines)
 
         # 如果找不到任何可以连接的线段，则退出
-        if not poly_to_append and not poly_to_prepend:
+        if append_index is None and prepend_index is None:
             break
 
         # 决定是连接头部还是尾部
         if dist_to_start < dist_to_end:
             # 连接头部：将找到的线段反转后加到前面
+            poly_to_prepend = unique_polylines[prepend_index]
             points = list(reversed(points_to_prepend))
             print(f"步骤 {step + 1}: 连接到头部 {current_start} -> 新线段 {poly_to_prepend.id} (连接点: {points[-1]})")
             merged_points = points[:-1] + merged_points
-            polylines_to_process.remove(poly_to_prepend)
+            _remove_from_endpoint_index(endpoint_index, endpoints, prepend_index)
         else:
             # 连接尾部：将找到的线段追加到后面
+            poly_to_append = unique_polylines[append_index]
             print(
                 f"步骤 {step + 1}: 连接到尾部 {current_end} -> 新线段 {poly_to_append.id} (连接点: {points_to_append[0]})")
             merged_points.extend(points_to_append[1:])
-            polylines_to_process.remove(poly_to_append)
+            _remove_from_endpoint_index(endpoint_index, endpoints, append_index)
+        remaining -= 1
 
         step += 1
         if log:
@@ -1,83 +1,68 @@
 
+import heapq
 import numpy as np
+import shapely
 from tqdm import tqdm
 from shapely.geometry import LineString
-from collections import defaultdict
-from rtree import index
+from utils.helpers import find_crossing_segment_pairs, cumulative_length, interpolate_xy
 
 # 去除交叉法线的处理
 
 def remove_crossing_normals(points_with_normals):
     """
-    去除相交的法线，只保留不交叉的法线。(使用RTree优化过程)
+    去除相交的法线，只保留不交叉的法线。(使用 STRtree 批量查询候选对，线段相交测试在 numba 编译内核中完成；
+    每次用最大堆取出交叉次数最多的法线，交叉次数相同时取编号最小者)
     """
     n = len(points_with_normals)
     alive = [True] * n  # 标记法线是否存活
 
-    #初始化RTree树
-    idx = index.Index(properties=index.Property(dimension=2))
-    for i in range(n):
-        line = points_with_normals[i][1]
-        idx.insert(i, line.bounds)
-
-    # 初始化交叉次数和相交关系
-    crossings = {}
-    intersecting_pairs = {}
+    # 批量找出相交的法线对：STRtree 候选 + 编译的线段方向测试
+    pair_i, pair_j = find_crossing_segment_pairs([p[1] for p in points_with_normals])
 
     # 初始统计交叉次数和相交关系
-    for i in range(n):
-        if not alive[i]:
-            continue
-        line1 = points_with_normals[i][1]
-        cross_count = 0
-        intersecting = set()
-
-        candidates=list(idx.intersection(line1.bounds))
-
-        for j in candidates:
-            if i == j or not alive[j]:
-                continue
-            line2 = points_with_normals[j][1]
-            if line1.intersects(line2):
-                cross_count += 1
-                intersecting.add(j)
-        crossings[i] = cross_count
-        intersecting_pairs[i] = intersecting
+    intersecting_pairs = {i: set() for i in range(n)}
+    for i, j in zip(pair_i.tolist(), pair_j.tolist()):
+        intersecting_pairs[i].add(j)
+        intersecting_pairs[j].add(i)
+    crossings = {i: len(intersecting_pairs[i]) for i in range(n)}
 
     # 计算初始交叉的法线数目
-    crossing_lines = [i for i in crossings if crossings[i] > 0 and alive[i]]
-    total_crossings = len(crossing_lines)
+    total_crossings = sum(1 for i in crossings if crossings[i] > 0)
+
+    # 最大堆：(-交叉次数, 编号)，交叉次数相同时编号小者优先；过期条目在弹出时跳过（惰性删除）
+    heap = [(-count, i) for i, count in crossings.items() if count > 0]
+    heapq.heapify(heap)
 
     pbar = tqdm(total=total_crossings, desc="Removing crossing normals", unit="line")
-    previous_crossings = total_crossings
 
-    while total_crossings > 0:
+    while total_crossings > 0 and heap:
         # 找到当前交叉次数最多的存活法线
-        candidates = [i for i in crossings if alive[i] and crossings[i] > 0]
-        if not candidates:
-            break
-        max_cross_index = max(candidates, key=lambda x: crossings[x])
+        neg_count, max_cross_index = heapq.heappop(heap)
+        if not alive[max_cross_index] or crossings[max_cross_index] != -neg_count:
+            continue
 
         # 移除该法线（标记为非存活）
         alive[max_cross_index] = False
+        removed = 1
 
         # 更新与该法线相交的其他法线的交叉次数
-        for m in intersecting_pairs.get(max_cross_index, set()):
+        for m in intersecting_pairs[max_cross_index]:
             if alive[m]:
                 crossings[m] -= 1
                 intersecting_pairs[m].discard(max_cross_index)
+                if crossings[m] > 0:
+                    heapq.heappush(heap, (-crossings[m], m))
+                else:
+                    removed += 1
 
         # 从字典中移除被删除的法线记录
         del crossings[max_cross_index]
         del intersecting_pairs[max_cross_index]
 
-        # 重新计算剩余交叉法线数目
-        current_crossing = sum(1 for i in crossings if alive[i] and crossings[i] > 0)
-        progress_increment = previous_crossings - current_crossing
-        pbar.update(progress_increment)
-        pbar.set_postfix({"Remaining": current_crossing})
-        previous_crossings = current_crossing
-        total_crossings = current_crossing
+        # 增量更新剩余交叉法线数目
+        total_crossings -= removed
+        pbar.update(removed)
+        pbar.set_postfix({"Remaining": total_crossings})
 
     pbar.set_postfix({"Final count": sum(alive)})
     pbar.close()
@@ -85,6 +70,36 @@ def remove_crossing_normals(points_with_normals):
     # 收集存活的法线
     return [p for i, p in enumerate(points_with_normals) if alive[i]]
 
+def _batch_intersection(lines, bank):
+    """
+    批量计算各法线与岸线的交集。批量计算出错时逐条重算，出错的法线记录其异常，留给调用方逐点处理。
+    """
+    try:
+        return shapely.intersection(lines, bank)
+    except Exception:
+        result = np.empty(len(lines), dtype=object)
+        for k, line in enumerate(lines):
+            try:
+                result[k] = shapely.intersection(line, bank)
+            except Exception as e:
+                result[k] = e
+        return result
+
+
+def _nearest_intersection(intersection, point):
+    """
+    从法线与岸线的交点中取距 point 最近的一个；没有交点时返回 None，交集计算出错时抛出记录的异常。
+    """
+    if isinstance(intersection, Exception):
+        raise intersection
+    if intersection.is_empty:
+        return None
+    if intersection.geom_type != 'MultiPoint':
+        return intersection
+    parts = shapely.get_parts(intersection)
+    return parts[np.argmin(shapely.distance(parts, point))]
+
+
 def generate_infinite_normals_on_linestring_with_polyline(line, north, south, interval=100,max_allowable_width=50000):
     """
     生成多段线上的法线，使用 north 和 south 作为参考线来计算法线方向。
@@ -96,63 +111,46 @@ def generate_infinite_normals_on_linestring_with_polyline(line, north, south, in
     :return: 返回包含法线的点与法线的元组列表。
     """
     line_length = line.length
-    points_with_normals = []  # 用于存储每个点和对应的法线
     print(f"分割距离为{interval}")
+    coords = np.asarray(line.coords, dtype=np.float64)[:, :2]
+    if len(coords) < 2:
+        return []
+    cumlen = cumulative_length(coords)
+    distances = np.arange(0, int(line_length) + 1, interval, dtype=np.float64)
+
+    # 一次性求出所有采样点及其前后 1 米处的点，切线取中心差分（首尾取单侧差分）
+    points_xy = interpolate_xy(coords, cumlen, distances)
+    prev_xy = interpolate_xy(coords, cumlen, np.where(distances == 0, distances, distances - 1))
+    next_xy = interpolate_xy(coords, cumlen, np.where(distances >= line_length, distances, distances + 1))
+    tangent_vectors = next_xy - prev_xy
+
+    # 计算法线方向，垂直于切线，并单位化
+    normal_vectors = np.column_stack([-tangent_vectors[:, 1], tangent_vectors[:, 0]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normal_vectors /= np.linalg.norm(normal_vectors, axis=1, keepdims=True)
+    valid = np.all(np.isfinite(normal_vectors), axis=1)
+    points_xy, normal_vectors = points_xy[valid], normal_vectors[valid]
+    points = shapely.points(points_xy)
+
+    # 使用 north 和 south 线确定法线的最终方向
+    in_north = shapely.contains_xy(north, points_xy[:, 0], points_xy[:, 1])
+    normal_vectors[in_north] *= -1  # 如果点在 north 线的北边，反转法线方向
+
+    # 生成所有无限法线，并一次性计算与 north 和 south 的交点
+    infinite_normal_lines = shapely.linestrings(
+        np.stack([points_xy - normal_vectors * 1e6, points_xy + normal_vectors * 1e6], axis=1))
+    intersections_with_north = _batch_intersection(infinite_normal_lines, north)
+    intersections_with_south = _batch_intersection(infinite_normal_lines, south)
+
+    points_with_normals = []  # 用于存储每个点和对应的法线
     # 使用 tqdm 来创建进度条
-    pbar = tqdm(range(0, int(line_length) + 1, interval), desc="Processing normals", unit="point")
+    pbar = tqdm(range(len(points)), desc="Processing normals", unit="point")
 
-    for distance in pbar:
+    for k in pbar:
         try:
-            point = line.interpolate(distance)
-
-            # 计算切线方向
-            if distance == 0:
-                next_point = line.interpolate(distance + 1)
-                tangent_vector = np.array([next_point.x - point.x, next_point.y - point.y])
-            elif distance >= line_length:
-                prev_point = line.interpolate(distance - 1)
-                tangent_vector = np.array([point.x - prev_point.x, point.y - prev_point.y])
-            else:
-                prev_point = line.interpolate(distance - 1)
-                next_point = line.interpolate(distance + 1)
-                tangent_vector = np.array([next_point.x - prev_point.x, next_point.y - prev_point.y])
-
-            # 计算法线方向，垂直于切线
-            normal_vector = np.array([-tangent_vector[1], tangent_vector[0]])
-            normal_vector = normal_vector / np.linalg.norm(normal_vector)  # 单位化法线
-
-            # 使用 north 和 south 线确定法线的最终方向
-            if north.contains(point):  # 如果点在 north 线的北边
-                normal_vector = -normal_vector  # 反转法线方向
-
-            # 生成无限法线
-            offset_start = np.array([point.x, point.y]) - (normal_vector * 1e6)
-            offset_end = np.array([point.x, point.y]) + (normal_vector * 1e6)
-            infinite_normal_line = LineString([offset_start, offset_end])
-
-            # 计算法线与 north 和 south 的交点
-            intersection_with_north = infinite_normal_line.intersection(north)
-            intersection_with_south = infinite_normal_line.intersection(south)
-
-            if intersection_with_north.is_empty and intersection_with_south.is_empty:
-                continue
-
-            north_points = []
-            if not intersection_with_north.is_empty:
-                if intersection_with_north.geom_type == 'MultiPoint':
-                    north_points.extend(intersection_with_north.geoms)
-                else:
-                    north_points.append(intersection_with_north)
-
-            south_points = []
-            if not intersection_with_south.is_empty:
-                if intersection_with_south.geom_type == 'MultiPoint':
-                    south_points.extend(intersection_with_south.geoms)
-                else:
-                    south_points.append(intersection_with_south)
-
-            north_point = min(north_points, key=lambda p: p.distance(point)) if north_points else None
-            south_point = min(south_points, key=lambda p: p.distance(point)) if south_points else None
+            point = points[k]
+            north_point = _nearest_intersection(intersections_with_north[k], point)
+            south_point = _nearest_intersection(intersections_with_south[k], point)
 
             if north_point and south_point:
                 normal_line = LineString([north_point, south_point])
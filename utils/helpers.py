@@ -1,9 +1,15 @@
+import numpy as np
 from matplotlib import pyplot as plt
-from rtree import index
-from shapely import MultiLineString, GeometryCollection, Polygon
+import shapely
+from shapely import MultiLineString, GeometryCollection, Polygon, STRtree
 from shapely.geometry import LineString, Point
 from shapely.ops import linemerge
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba 为可选依赖，未安装时使用 numpy 实现
+    njit = None
+
 
 def parallel_line_through_point(line, point, distance):
     """
@@ -39,30 +45,275 @@ def find_intersection(line1, line2):
     return None
 
 
-def make_shape_finder(closed_shapes):
+def cumulative_length(coords):
     """
-    创建并返回一个针对固定封闭形状的查询函数，该函数使用Rtree进行优化。
+    计算折线坐标数组 (N, 2) 的累积弧长 (N,)，首元素为 0。
+    与 GEOS 相同，逐段 sqrt(dx*dx + dy*dy) 按顺序累加，可与 interpolate_xy 配合逐位复现 LineString.interpolate。
     """
-    # 构建Rtree索引
-    idx = index.Index()
-    for i, shape in enumerate(closed_shapes):
-        # 获取形状的边界框（min_x, min_y, max_x, max_y）
-        bbox = shape.polygon.bounds
-        idx.insert(i, bbox)
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    cumlen = np.zeros(len(coords))
+    if len(coords) > 1:
+        seg = np.diff(coords, axis=0)
+        np.cumsum(np.sqrt(seg[:, 0] * seg[:, 0] + seg[:, 1] * seg[:, 1]), out=cumlen[1:])
+    return cumlen
 
-    def find_point(point):
-        # 查询点的坐标范围（作为矩形）
-        query_bbox = (point.x, point.y, point.x, point.y)
-        # 获取所有相交的候选索引
-        candidate_indices = idx.intersection(query_bbox)
-        # 按原始顺序检查候选形状
-        for i in sorted(candidate_indices):
-            shape = closed_shapes[i]
-            if shape.polygon.contains(point):
-                return i, shape
-        return None
 
-    return find_point
+def interpolate_xy(coords, cumlen, distances):
+    """
+    批量求折线上各距离处的点坐标（距离不小于 0），逐步复现 GEOS 的 LineString.interpolate（含浮点运算顺序），结果与之逐位一致。
+    cumlen 为 cumulative_length 给出的顶点累积弧长；超出总长的距离取终点。
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    seg_start = cumlen[:-1]
+    seg_len = np.diff(coords, axis=0)
+    seg_len = np.sqrt(seg_len[:, 0] * seg_len[:, 0] + seg_len[:, 1] * seg_len[:, 1])
+    # 第一条满足 起点弧长 + 线段长 > distance 的线段
+    k = np.searchsorted(seg_start + seg_len, distances, side='right')
+    xy = np.tile(coords[-1], (len(distances), 1))
+    inside = k < len(seg_len)
+    k = k[inside]
+    frac = (distances[inside] - seg_start[k]) / seg_len[k]
+    p0, p1 = coords[k], coords[k + 1]
+    xy[inside] = np.column_stack([p0[:, 0] + frac * (p1[:, 0] - p0[:, 0]),
+                                  p0[:, 1] + frac * (p1[:, 1] - p0[:, 1])])
+    return xy
+
+
+def make_shape_locator(closed_shapes):
+    """
+    创建并返回针对固定封闭形状的批量查询函数 locate(xs, ys)，为一批点坐标返回所在封闭形状的索引数组，找不到时为 -1。
+    STRtree 只构建一次，每批点用一次 within 谓词查询完成；与 polygon.contains 一致，落在边界上的点不属于该形状。
+    同一点落在多个形状内时取编号最小者。
+    """
+    polygons = [shape.polygon for shape in closed_shapes]
+    tree = STRtree(polygons)
+
+    def locate(xs, ys):
+        result = np.full(len(xs), -1, dtype=np.int64)
+        if not polygons or len(xs) == 0:
+            return result
+        point_idx, shape_idx = tree.query(shapely.points(xs, ys), predicate='within')
+        if len(point_idx):
+            # 同一点命中多个形状时取编号最小者
+            order = np.lexsort((shape_idx, point_idx))
+            first = order[np.r_[0, np.flatnonzero(np.diff(point_idx[order])) + 1]]
+            result[point_idx[first]] = shape_idx[first]
+        return result
+
+    return locate
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _project_points_kernel(points_xy, line_coords, line_cumlen, starts, ends, s, proj_xy):
+        for i in prange(points_xy.shape[0]):
+            start, end = starts[i], ends[i]
+            if end <= start:
+                continue
+            px, py = points_xy[i, 0], points_xy[i, 1]
+            # 单顶点折线：投影点即该顶点
+            s[i] = line_cumlen[start]
+            proj_xy[i, 0], proj_xy[i, 1] = line_coords[start, 0], line_coords[start, 1]
+            best = np.inf
+            for k in range(start, end - 1):
+                ax, ay = line_coords[k, 0], line_coords[k, 1]
+                abx, aby = line_coords[k + 1, 0] - ax, line_coords[k + 1, 1] - ay
+                len2 = abx * abx + aby * aby
+                t = 0.0
+                if len2 > 0:
+                    t = min(max(((px - ax) * abx + (py - ay) * aby) / len2, 0.0), 1.0)
+                fx, fy = ax + t * abx, ay + t * aby
+                d2 = (px - fx) * (px - fx) + (py - fy) * (py - fy)
+                if d2 < best:
+                    best = d2
+                    s[i] = line_cumlen[k] + t * np.sqrt(len2)
+                    proj_xy[i, 0], proj_xy[i, 1] = fx, fy
+
+
+def project_points_onto_polylines(points_xy, line_coords, line_cumlen, line_offsets, line_ids=None):
+    """
+    将 points_xy[i] 投影到第 line_ids[i] 条折线上（line_ids 为 None 时为第 i 条），
+    折线 j 的顶点为 line_coords[line_offsets[j]:line_offsets[j + 1]]，line_cumlen 为对应顶点的累积弧长。
+    多个点共用同一条折线时，折线坐标只需存储一次。
+    安装了 numba 时使用并行编译内核，否则用 numpy 一次性广播计算。
+    返回 (沿线弧长坐标 (M,), 投影点坐标 (M, 2))；顶点数为 0 的折线结果为 NaN。
+    与 LineString.project 一致，距离相同时取第一条线段。
+    """
+    points_xy = np.asarray(points_xy, dtype=np.float64).reshape(-1, 2)
+    line_coords = np.ascontiguousarray(line_coords, dtype=np.float64).reshape(-1, 2)
+    line_cumlen = np.ascontiguousarray(line_cumlen, dtype=np.float64)
+    line_offsets = np.asarray(line_offsets, dtype=np.int64)
+    starts, ends = line_offsets[:-1], line_offsets[1:]
+    if line_ids is not None:
+        line_ids = np.asarray(line_ids, dtype=np.int64)
+        starts, ends = starts[line_ids], ends[line_ids]
+    m = len(points_xy)
+    s = np.full(m, np.nan)
+    proj_xy = np.full((m, 2), np.nan)
+
+    if njit is not None:
+        _project_points_kernel(points_xy, line_coords, line_cumlen, np.ascontiguousarray(starts),
+                               np.ascontiguousarray(ends), s, proj_xy)
+        return s, proj_xy
+
+    n_vertices = ends - starts
+    # 单顶点折线视为一条零长度线段，投影点即该顶点
+    n_segments = np.maximum(n_vertices - 1, np.minimum(n_vertices, 1))
+    total = int(n_segments.sum())
+    if total == 0:
+        return s, proj_xy
+
+    owner = np.repeat(np.arange(m), n_segments)
+    seg_start = np.arange(total) - np.repeat(np.cumsum(n_segments) - n_segments, n_segments) \
+        + np.repeat(starts, n_segments)
+    seg_end = np.minimum(seg_start + 1, np.repeat(ends - 1, n_segments))
+
+    a = line_coords[seg_start]
+    ab = line_coords[seg_end] - a
+    ap = points_xy[owner] - a
+    len2 = np.einsum('ij,ij->i', ab, ab)
+    t = np.divide(np.einsum('ij,ij->i', ap, ab), len2, out=np.zeros(total), where=len2 > 0)
+    np.clip(t, 0.0, 1.0, out=t)
+    foot = a + t[:, None] * ab
+    diff = points_xy[owner] - foot
+    dist2 = np.einsum('ij,ij->i', diff, diff)
+
+    # 每个点取距离最小的线段（并列时取编号最小者）
+    order = np.lexsort((np.arange(total), dist2, owner))
+    first = order[np.r_[0, np.flatnonzero(np.diff(owner[order])) + 1]]
+    hit = owner[first]
+    s[hit] = line_cumlen[seg_start[first]] + t[first] * np.sqrt(len2[first])
+    proj_xy[hit] = foot[first]
+    return s, proj_xy
+
+
+def make_line_projector(line):
+    """
+    为一条固定的长折线创建批量投影函数 project(points_xy) -> (沿线弧长坐标, 投影点坐标)。
+    顶点、累积弧长和线段 STRtree 只构建一次；每个点通过最近线段查询直接定位，不必遍历整条线。
+    与 LineString.project 一致，距离相同时取第一条线段。
+    """
+    coords = np.asarray(line.coords, dtype=np.float64).reshape(-1, 2)
+    if len(coords) < 2:
+        def project_degenerate(points_xy):
+            points = shapely.points(np.asarray(points_xy, dtype=np.float64).reshape(-1, 2))
+            s = shapely.line_locate_point(line, points)
+            return s, shapely.get_coordinates(shapely.line_interpolate_point(line, s))
+        return project_degenerate
+
+    seg_vec = np.diff(coords, axis=0)
+    seg_len2 = np.einsum('ij,ij->i', seg_vec, seg_vec)
+    cumlen = cumulative_length(coords)
+    tree = STRtree(shapely.linestrings(np.stack([coords[:-1], coords[1:]], axis=1)))
+
+    def project(points_xy):
+        points_xy = np.asarray(points_xy, dtype=np.float64).reshape(-1, 2)
+        if len(points_xy) == 0:
+            return np.empty(0), np.empty((0, 2))
+        point_idx, seg_idx = tree.query_nearest(shapely.points(points_xy), all_matches=True)
+        # 等距的多条线段中取编号最小者
+        order = np.lexsort((seg_idx, point_idx))
+        first = order[np.r_[0, np.flatnonzero(np.diff(point_idx[order])) + 1]]
+        k = np.empty(len(points_xy), dtype=np.int64)
+        k[point_idx[first]] = seg_idx[first]
+
+        ap = points_xy - coords[k]
+        t = np.divide(np.einsum('ij,ij->i', ap, seg_vec[k]), seg_len2[k],
+                      out=np.zeros(len(k)), where=seg_len2[k] > 0)
+        np.clip(t, 0.0, 1.0, out=t)
+        s = cumlen[k] + t * np.sqrt(seg_len2[k])
+        return s, coords[k] + t[:, None] * seg_vec[k]
+
+    return project
+
+
+def _segment_pairs_intersect_numpy(segs, pair_i, pair_j):
+    """
+    判断线段 segs[pair_i[k]] 与 segs[pair_j[k]] 是否相交（含端点接触与共线重叠），numpy 向量化实现。
+    segs 为 (N, 4) 数组，每行为 (x1, y1, x2, y2)。零长度线段按 GEOS 的约定处理。
+    """
+    a, b = segs[pair_i, :2], segs[pair_i, 2:]
+    c, d = segs[pair_j, :2], segs[pair_j, 2:]
+
+    def orient(p, q, r):
+        return np.sign((q[:, 0] - p[:, 0]) * (r[:, 1] - p[:, 1]) - (q[:, 1] - p[:, 1]) * (r[:, 0] - p[:, 0]))
+
+    o1, o2, o3, o4 = orient(a, b, c), orient(a, b, d), orient(c, d, a), orient(c, d, b)
+    collinear = (o1 == 0) & (o2 == 0) & (o3 == 0) & (o4 == 0)
+    # 四点共线时退化为两线段包围盒是否重叠
+    overlap = np.all(np.minimum(a, b) <= np.maximum(c, d), axis=1) & \
+        np.all(np.minimum(c, d) <= np.maximum(a, b), axis=1)
+    # 与 GEOS 一致，零长度线段只与重合的零长度线段相交
+    degenerate_ab, degenerate_cd = np.all(a == b, axis=1), np.all(c == d, axis=1)
+    hit = (o1 * o2 <= 0) & (o3 * o4 <= 0) & (~collinear | overlap) & ~(degenerate_ab | degenerate_cd)
+    return hit | (degenerate_ab & degenerate_cd & np.all(a == c, axis=1))
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _orient(px, py, qx, qy, rx, ry):
+        v = (qx - px) * (ry - py) - (qy - py) * (rx - px)
+        return (v > 0) - (v < 0)
+
+    @njit(cache=True)
+    def _segments_intersect(ax, ay, bx, by, cx, cy, dx, dy):
+        """
+        两线段是否相交（含端点接触与共线重叠），基于叉积符号的方向测试。
+        """
+        degenerate_ab = ax == bx and ay == by
+        degenerate_cd = cx == dx and cy == dy
+        if degenerate_ab or degenerate_cd:
+            return degenerate_ab and degenerate_cd and ax == cx and ay == cy
+        o1 = _orient(ax, ay, bx, by, cx, cy)
+        o2 = _orient(ax, ay, bx, by, dx, dy)
+        o3 = _orient(cx, cy, dx, dy, ax, ay)
+        o4 = _orient(cx, cy, dx, dy, bx, by)
+        if o1 * o2 > 0 or o3 * o4 > 0:
+            return False
+        if o1 == 0 and o2 == 0 and o3 == 0 and o4 == 0:
+            return (min(ax, bx) <= max(cx, dx) and min(cx, dx) <= max(ax, bx)
+                    and min(ay, by) <= max(cy, dy) and min(cy, dy) <= max(ay, by))
+        return True
+
+    @njit(parallel=True, cache=True)
+    def _segment_pairs_intersect_kernel(segs, pair_i, pair_j, hit):
+        for k in prange(len(pair_i)):
+            i, j = pair_i[k], pair_j[k]
+            hit[k] = _segments_intersect(segs[i, 0], segs[i, 1], segs[i, 2], segs[i, 3],
+                                         segs[j, 0], segs[j, 1], segs[j, 2], segs[j, 3])
+
+    def _segment_pairs_intersect(segs, pair_i, pair_j):
+        """
+        _segment_pairs_intersect_numpy 的 numba 编译版本：逐对并行判断，不构建中间数组。
+        """
+        hit = np.zeros(len(pair_i), dtype=np.bool_)
+        _segment_pairs_intersect_kernel(np.ascontiguousarray(segs, dtype=np.float64),
+                                        np.asarray(pair_i, dtype=np.int64),
+                                        np.asarray(pair_j, dtype=np.int64), hit)
+        return hit
+else:
+    _segment_pairs_intersect = _segment_pairs_intersect_numpy
+
+
+def find_crossing_segment_pairs(lines):
+    """
+    找出一组线几何中所有相交的 (i, j) 对（i < j），返回两个索引数组。
+    先用 STRtree 一次性批量查询包围盒重叠的候选对；
+    若全部为两点线段，则直接在 (N, 4) 端点数组上做方向测试，否则退回 shapely.intersects。
+    """
+    lines = np.asarray(lines, dtype=object)
+    if len(lines) < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pair_i, pair_j = STRtree(lines).query(lines)
+    keep = pair_i < pair_j
+    pair_i, pair_j = pair_i[keep], pair_j[keep]
+    if np.all(shapely.get_num_coordinates(lines) == 2):
+        segs = shapely.get_coordinates(lines).reshape(-1, 4)
+        hit = _segment_pairs_intersect(segs, pair_i, pair_j)
+    else:
+        hit = shapely.intersects(lines[pair_i], lines[pair_j])
+    return pair_i[hit], pair_j[hit]
+
 
 def merge_lines(lines):
     """